@@ -1,76 +1,94 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import orjson
 import plotly.express as px
 import asyncio
+import atexit
+import contextlib
+import contextvars
+import functools
+import hashlib
+import io
 import os
+import pathlib
 import subprocess
+import sys
 import random
 import re
-from playwright.async_api import async_playwright
-from bs4 import BeautifulSoup
+import sqlite3
+import threading
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from selectolax.lexbor import LexborHTMLParser
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
+from urllib.parse import urlsplit
+
+try:
+    import uvloop
+except ImportError:  # Windows has no uvloop; fall back to the stock loop
+    uvloop = None
 
 # --- 1. MUST BE THE ABSOLUTE FIRST STREAMLIT COMMAND ---
 st.set_page_config(page_title="Dubizzle Arbitrage Pro", layout="wide", page_icon="🚀")
 
 # --- BROWSER INITIALIZATION FOR STREAMLIT CLOUD ---
 def install_playwright_browsers():
+    # The installer knows the exact Chromium and headless-shell revisions this
+    # Playwright launches and skips them when present; a directory glob would
+    # also accept a stale revision left by an older release.
     try:
-        subprocess.run(["playwright", "install", "chromium"], check=True)
+        subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
         return True
     except Exception as e:
         print(f"Error installing browser binaries: {e}")
         return False
 
-if 'browser_installed' not in st.session_state:
-    with st.spinner("Setting up browser environment..."):
-        if install_playwright_browsers():
-            st.session_state.browser_installed = True
+# Once per process, not per session; a failed install is retried on next use.
+@st.cache_resource(show_spinner="Setting up browser environment...", validate=bool)
+def ensure_browser_installed():
+    return install_playwright_browsers()
+
+ensure_browser_installed()
 
 # --- DEBUGGING UTILS ---
+MAX_LOG_LINES = 30
+
 if 'debug_logs' not in st.session_state:
-    st.session_state.debug_logs = []
+    st.session_state.debug_logs = deque(maxlen=MAX_LOG_LINES)
+
+# Scrapes run on the shared event loop thread, where st.session_state is
+# not reachable; the calling session's log buffer travels in this context var.
+_log_buffer = contextvars.ContextVar("log_buffer", default=None)
 
 def add_log(msg):
+    logs = _log_buffer.get()
+    if logs is None:
+        logs = st.session_state.debug_logs
     timestamp = datetime.now().strftime("%H:%M:%S")
-    st.session_state.debug_logs.append(f"[{timestamp}] {msg}")
-    if len(st.session_state.debug_logs) > 30:
-        st.session_state.debug_logs.pop(0)
+    logs.append(f"[{timestamp}] {msg}")
 
 # --- PROXY PARSER ---
-def parse_proxy(proxy_str):
-    """
-    Enhanced Proxy Parser.
-    Handles:
-    - user:pass@host:port
-    - host:port:user:pass
-    - host:port
-    Automatically adds http:// if protocol is missing.
-    """
-    proxy_str = proxy_str.strip()
-    if not proxy_str:
-        return None
-    
+_HOST_PORT_USER_PASS_RE = re.compile(r"^([^:]+):(\d+):([^:]+):(.+)$")
+_PROXY_RE = re.compile(r"^(?:https?://)?(?:(?P<user>[^:]+):(?P<pwd>[^@]+)@)?(?P<host>[^:/]+):(?P<port>\d+)$")
+
+@functools.lru_cache(maxsize=1024)
+def _parse_proxy(proxy_str):
     # Check for host:port:user:pass format first
-    parts = proxy_str.split(':')
-    if len(parts) == 4:
-        return {
-            "server": f"http://{parts[0]}:{parts[1]}",
-            "username": parts[2],
-            "password": parts[3]
-        }
+    match = _HOST_PORT_USER_PASS_RE.match(proxy_str)
+    if match:
+        host, port, user, pwd = match.groups()
+        return {"server": f"http://{host}:{port}", "username": user, "password": pwd}
     
     # Check for user:pass@host:port (or variations with/without http)
-    regex = r"^(?:https?://)?(?:(?P<user>[^:]+):(?P<pass>[^@]+)@)?(?P<host>[^:]+):(?P<port>\d+)$"
-    match = re.match(regex, proxy_str)
-    
+    match = _PROXY_RE.match(proxy_str)
     if match:
         d = match.groupdict()
         config = {"server": f"http://{d['host']}:{d['port']}"}
-        if d['user'] and d['pass']:
+        if d['user'] and d['pwd']:
             config["username"] = d['user']
-            config["password"] = d['pass']
+            config["password"] = d['pwd']
         return config
     
     # Fallback: Just assume it's host:port if it looks like it
@@ -80,6 +98,22 @@ def parse_proxy(proxy_str):
         
     return None
 
+def parse_proxy(proxy_str):
+    """
+    Enhanced Proxy Parser.
+    Handles:
+    - user:pass@host:port
+    - host:port:user:pass
+    - host:port
+    Automatically adds http:// if protocol is missing.
+    Results are memoized; callers get their own copy of the dict.
+    """
+    proxy_str = proxy_str.strip()
+    if not proxy_str:
+        return None
+    config = _parse_proxy(proxy_str)
+    return dict(config) if config else None
+
 # --- CONFIGURATION & STYLING ---
 st.markdown("""
     <style>
@@ -98,19 +132,359 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
+# --- WARM BROWSER ---
+REQUESTS_PER_SECOND = 2
+
+class RateLimiter:
+    """
+    Token bucket: allows bursts of up to `burst` requests, then one every
+    1/rate seconds. acquire() awaits instead of blocking the loop thread.
+    """
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in FIFO order.
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+@dataclass
+class BrowserPool:
+    """
+    One Playwright driver and Chromium shared by every scan in the process.
+    Scans lease cheap contexts from it; max_contexts bounds how many are open
+    at once across all sessions, warm ones included. warm_pages holds one
+    long-lived page per proxy login for single-category scans, least
+    recently used first; rate_limiters paces navigations per proxy so
+    concurrent scans don't hammer the site from one IP. Both are capped,
+    since every visitor can paste a different proxy list.
+    """
+    playwright: object
+    browser: object
+    max_contexts: int = 8
+    max_warm_pages: int = 4
+    max_rate_limiters: int = 64
+    warm_pages: OrderedDict = field(default_factory=OrderedDict)
+    rate_limiters: OrderedDict = field(default_factory=OrderedDict)
+
+    def __post_init__(self):
+        self._slots = asyncio.Semaphore(self.max_contexts)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, proxy_config=None):
+        async with self._slots:
+            context = await _new_scrape_context(self.browser, proxy_config)
+            try:
+                yield context
+            finally:
+                await context.close()
+                add_log("Browser context closed.")
+
+    @contextlib.asynccontextmanager
+    async def warm_page(self, proxy_config=None):
+        # One page per proxy login, used serially; the lock also guards its
+        # creation. A context keeps the credentials it was made with, so
+        # gateways shared by several accounts must not share a page.
+        # Yields the page's state dict: {"lock", "users", "context", "page",
+        # "warmed", "discard"}; a scan sets "discard" to have the page closed
+        # after it. "users" counts scans holding or waiting on the page.
+        key = (proxy_config['server'], proxy_config.get('username'), proxy_config.get('password')) if proxy_config else None
+        warm = self.warm_pages.get(key)
+        if warm is None:
+            warm = self.warm_pages[key] = {
+                "lock": asyncio.Lock(), "users": 0, "context": None, "page": None, "warmed": False, "discard": False
+            }
+        else:
+            self.warm_pages.move_to_end(key)
+        warm["users"] += 1
+        try:
+            await self._evict_warm_pages()
+            async with warm["lock"]:
+                if warm["page"] is None or warm["page"].is_closed():
+                    await self._discard_warm_page(warm)
+                    # A warm context holds a slot for as long as it stays open.
+                    await self._slots.acquire()
+                    try:
+                        warm["context"] = await _new_scrape_context(self.browser, proxy_config)
+                    except BaseException:
+                        self._slots.release()
+                        raise
+                    warm["page"] = await warm["context"].new_page()
+                    add_log("Opened warm page.")
+                try:
+                    yield warm
+                finally:
+                    if warm["discard"]:
+                        await self._discard_warm_page(warm)
+        finally:
+            warm["users"] -= 1
+            # Pages busy at the last eviction may have pushed the map past the
+            # cap; trimming now frees their slots for scans waiting on one.
+            await self._evict_warm_pages()
+
+    async def _evict_warm_pages(self):
+        # Oldest idle pages go first; pages in use or awaited are left alone.
+        # Keep max_warm_pages below max_contexts so idle pages never hold
+        # every slot.
+        while len(self.warm_pages) > self.max_warm_pages:
+            idle = next((k for k, w in self.warm_pages.items() if not w["users"]), None)
+            if idle is None:
+                break
+            await self._discard_warm_page(self.warm_pages.pop(idle))
+            add_log("Evicted idle warm page.")
+
+    async def _discard_warm_page(self, warm):
+        """Close a warm page's context and free its slot."""
+        context, warm["context"], warm["page"], warm["warmed"], warm["discard"] = warm["context"], None, None, False, False
+        if context is not None:
+            try:
+                with contextlib.suppress(Exception):
+                    await context.close()
+            finally:
+                self._slots.release()
+
+    def limiter(self, proxy_config=None):
+        key = proxy_config['server'] if proxy_config else None
+        limiter = self.rate_limiters.get(key)
+        if limiter is None:
+            limiter = self.rate_limiters[key] = RateLimiter()
+            if len(self.rate_limiters) > self.max_rate_limiters:
+                self.rate_limiters.popitem(last=False)
+        else:
+            self.rate_limiters.move_to_end(key)
+        return limiter
+
+    async def close(self):
+        await self.browser.close()
+        await self.playwright.stop()
+
+async def _launch_pool():
+    pw = await async_playwright().start()
+    browser = await pw.chromium.launch(
+        headless=True,
+        args=[
+            '--disable-blink-features=AutomationControlled',
+            '--no-sandbox',
+            '--disable-setuid-sandbox',
+            '--disable-web-security'
+        ]
+    )
+    return BrowserPool(pw, browser)
+
+@st.cache_resource(show_spinner=False)
+def get_loop():
+    """
+    One event loop per process, running forever on a daemon thread.
+    Playwright objects are bound to the loop that created them, so the warm
+    browser and every scrape must share this loop rather than asyncio.run().
+    uvloop is used when available for lower per-task overhead under fan-out.
+    """
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+async def _with_logs(coro, logs):
+    _log_buffer.set(logs)
+    return await coro
+
+def run_async(coro):
+    coro = _with_logs(coro, st.session_state.debug_logs)
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+@st.cache_resource(show_spinner=False, validate=lambda pool: pool.browser.is_connected())
+def get_browser_pool():
+    loop = get_loop()
+    pool = run_async(_launch_pool())
+    atexit.register(lambda: asyncio.run_coroutine_threadsafe(pool.close(), loop).result(timeout=10))
+    return pool
+
 # --- REAL SCRAPER ENGINE ---
-async def scrape_dubizzle(search_query, debug_mode=False, proxy_list=None):
-    results = []
+LISTING_CARD_SELECTOR = 'div[data-testid="listing-card"]'
+TITLE_SELECTOR = 'h2[data-testid="listing-title"]'
+PRICE_SELECTOR = 'div[data-testid="listing-price"]'
+LOCATION_SELECTOR = 'span[data-testid="listing-location"]'
+_NON_DIGIT = re.compile(r'\D+')
+_MAX_PRICE = np.iinfo(np.int32).max
+
+# The parser only reads the HTML, so everything else is dead weight.
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet", "other"}
+BLOCKED_HOSTS = re.compile(r"google-analytics|googletagmanager|doubleclick|facebook|hotjar")
+
+async def _block_heavy_resources(route):
+    request = route.request
+    # Match the host only; query strings like utm_source=facebook are fine.
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or BLOCKED_HOSTS.search(urlsplit(request.url).hostname or ""):
+        await route.abort()
+    else:
+        await route.continue_()
+
+LISTING_DTYPES = {'Price': 'int32', 'Model': 'category', 'Location': 'category'}
+
+def listings_frame(search_query, titles, prices, locations, links):
+    """Build the listings DataFrame in one call from pre-filled columns."""
+    return pd.DataFrame({
+        "Timestamp": pd.Timestamp.now(),
+        "Title": titles,
+        "Model": pd.Categorical.from_codes(np.zeros(len(titles), dtype=np.int8), [search_query]),
+        "Price": prices,
+        "Location": pd.Categorical(locations),
+        "Link": links,
+    }, copy=False)
+
+def parse_listing_cards(listings, search_query):
+    """Extract listings from the rendered DOM card nodes."""
+    n = len(listings)
+    titles, locations, links = [None] * n, [None] * n, [None] * n
+    prices = np.empty(n, dtype=np.int32)
+    count = 0
+    for item in listings:
+        title_elem = item.css_first(TITLE_SELECTOR)
+        price_elem = item.css_first(PRICE_SELECTOR)
+        if title_elem is None or price_elem is None:
+            continue
+        # "Price on request" and skeleton cards carry no digits; skip them.
+        digits = _NON_DIGIT.sub('', price_elem.text())
+        if not digits:
+            continue
+        price_val = int(digits)
+        if price_val > _MAX_PRICE:
+            continue
+
+        link_elem = item.css_first('a')
+        location_elem = item.css_first(LOCATION_SELECTOR)
+        raw_link = (link_elem.attributes.get('href') if link_elem else None) or "#"
+
+        titles[count] = title_elem.text().strip()
+        prices[count] = price_val
+        locations[count] = location_elem.text().strip() if location_elem else "UAE"
+        links[count] = raw_link if raw_link.startswith('http') else "https://uae.dubizzle.com" + raw_link
+        count += 1
+
+    return listings_frame(search_query, titles[:count], prices[:count], locations[:count], links[:count])
+
+# With heavy resources blocked and commit/selector waits, 15s is generous.
+NAVIGATION_TIMEOUT_MS = 15000
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
+]
+
+async def _new_scrape_context(browser, proxy_config):
+    context = await browser.new_context(
+        user_agent=random.choice(USER_AGENTS),
+        viewport={'width': 1280, 'height': 800},
+        java_script_enabled=True,
+        proxy=proxy_config
+    )
+    context.set_default_navigation_timeout(NAVIGATION_TIMEOUT_MS)
+    await context.route("**/*", _block_heavy_resources)
+    await context.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+    return context
+
+async def _scrape_page(page, search_query, capture_screenshot=False, session=None, limiter=None):
+    """
+    Run one search on an open page.
+    session is the warm page's state dict, if any: once its homepage visit
+    has set cookies, later scans go straight to the search URL until a
+    block or auth failure forces a re-warm. limiter, if given, is awaited
+    before each navigation.
+    Returns (df, screenshot, html_sample, status_code).
+    """
+    df = listings_frame(search_query, [], np.empty(0, np.int32), [], [])
     base_url = "https://uae.dubizzle.com/en/"
     search_url = f"https://uae.dubizzle.com/en/classified/search/?q={search_query.replace(' ', '+')}"
     
-    add_log(f"Starting Scrape for: {search_query}")
-    
     screenshot_data = None
     html_sample = ""
     status_code = 0
-    proxy_config = None
 
+    try:
+        if session and session["warmed"]:
+            add_log("Reusing warm session cookies.")
+        else:
+            add_log("Connecting via proxy and setting cookies...")
+            if limiter: await limiter.acquire()
+            response = await page.goto(base_url, wait_until="domcontentloaded")
+            add_log(f"Initial Connection Status: {response.status}")
+            
+            if response.status == 407:
+                add_log("CRITICAL: Proxy Authentication Required (407).")
+                if session is not None:
+                    session["discard"] = True
+                return df, None, "407 Error", 407
+
+        add_log(f"Fetching search results...")
+        if limiter: await limiter.acquire()
+        response = await page.goto(search_url, wait_until="commit")
+        status_code = response.status
+        add_log(f"Search Results Status: {status_code}")
+
+        try:
+            await page.wait_for_selector(LISTING_CARD_SELECTOR, timeout=15000)
+        except PlaywrightTimeoutError:
+            add_log("No listing cards rendered within 15s.")
+
+        if capture_screenshot:
+            try:
+                add_log("Capturing visual state...")
+                # Above-the-fold only; the debug view never needs the full viewport.
+                screenshot_data = await page.screenshot(
+                    type="jpeg", quality=35, full_page=False, timeout=10000, animations="disabled",
+                    clip={'x': 0, 'y': 0, 'width': 1280, 'height': 600}
+                )
+                add_log("Screenshot saved.")
+            except Exception as e:
+                add_log(f"Screenshot skipped: {str(e)}")
+
+        page_content = await page.content()
+        blocked = "Incapsula" in page_content or "incident_id" in page_content
+        if blocked:
+            add_log("Firewall Block detected in HTML content.")
+        if session is not None:
+            session["warmed"] = not blocked and status_code not in (403, 407)
+            session["discard"] = status_code == 407
+        
+        html_sample = page_content[:1000]
+        
+        # Parsing is pure CPU; off the loop, other scans' navigations keep moving.
+        df, n_cards = await asyncio.get_running_loop().run_in_executor(None, parse_page, page_content, search_query)
+        if n_cards is None:
+            add_log(f"Extracted {len(df)} items from __NEXT_DATA__.")
+        else:
+            add_log(f"Parsed {n_cards} items from the page.")
+                
+    except Exception as e:
+        add_log(f"ERROR: {str(e)}")
+        if session is not None:
+            session["warmed"] = False
+
+    return df, screenshot_data, html_sample, status_code
+
+async def scrape_dubizzle(pool, search_query, capture_screenshot=False, proxy_list=None, warm=False):
+    """
+    Scrape one search query on the shared browser pool.
+    With warm=True, reuse the pool's long-lived page for the chosen proxy so
+    repeat scans keep cookies and the HTTP/2 connection; otherwise lease a
+    throwaway context.
+    Returns (df, screenshot, html_sample, status_code, proxy_config).
+    """
+    add_log(f"Starting Scrape for: {search_query}")
+
+    proxy_config = None
     if proxy_list:
         raw_proxy = random.choice(proxy_list)
         proxy_config = parse_proxy(raw_proxy)
@@ -119,112 +493,401 @@ async def scrape_dubizzle(search_query, debug_mode=False, proxy_list=None):
             if "username" in proxy_config:
                 add_log("Proxy credentials applied successfully.")
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            proxy=proxy_config,
-            args=[
-                '--disable-blink-features=AutomationControlled',
-                '--no-sandbox',
-                '--disable-setuid-sandbox',
-                '--disable-web-security'
-            ]
+    limiter = pool.limiter(proxy_config)
+    if warm:
+        async with pool.warm_page(proxy_config) as session:
+            return (*await _scrape_page(session["page"], search_query, capture_screenshot, session, limiter), proxy_config)
+
+    async with pool.acquire(proxy_config) as context:
+        page = await context.new_page()
+        return (*await _scrape_page(page, search_query, capture_screenshot, limiter=limiter), proxy_config)
+
+async def scrape_many(pool, queries, proxy_list=None, max_concurrency=5):
+    """
+    Fan out one leased context per query, at most max_concurrency at a
+    time, so navigation waits overlap. Rows from non-200 responses are
+    dropped, so a blocked category comes back empty.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def bounded(query):
+        async with sem:
+            df, _, _, status_code, _ = await scrape_dubizzle(pool, query, proxy_list=proxy_list)
+            if status_code != 200:
+                add_log(f"Discarding {query}: status {status_code}.")
+                return df.iloc[:0]
+            return df
+
+    frames = await asyncio.gather(*(bounded(q) for q in queries))
+    # Per-query categoricals have disjoint categories; re-unify after concat.
+    return pd.concat(frames, ignore_index=True).astype(LISTING_DTYPES)
+
+# --- NEXT.JS PAYLOAD ---
+# Dubizzle is a Next.js app and ships its page data as JSON; reading that is
+# cheaper and sturdier than walking the DOM. The payload layout is not a
+# public contract, so listings are found by shape, but only inside search-hit
+# containers; recommended and promoted ads elsewhere in the blob are skipped.
+_NEXT_DATA_RE = re.compile(r'<script id="__NEXT_DATA__"[^>]*>(.+?)</script>', re.S)
+_HIT_KEYS = {"hits", "listings", "results", "ads"}
+_PROMO_KEYS = {"recommended", "recommendations", "featured", "promoted", "sponsored", "related", "similar"}
+_TITLE_KEYS = ("name", "title")
+_LINK_KEYS = ("absolute_url", "url", "permalink")
+_LOCATION_KEYS = ("location", "neighbourhood", "neighborhood", "city")
+
+def _field(obj, keys):
+    for key in keys:
+        value = obj.get(key)
+        if isinstance(value, dict):
+            value = value.get("en") or value.get("name") or value.get("value")
+        if isinstance(value, list):
+            value = value[-1] if value else None
+            if isinstance(value, dict):
+                value = value.get("en") or value.get("name")
+        if value not in (None, ""):
+            return value
+    return None
+
+def _iter_listing_objects(data):
+    # Queue entries carry whether the node sits under a search-hit key.
+    queue = deque([(data, False)])
+    while queue:
+        node, in_hits = queue.popleft()
+        if isinstance(node, dict):
+            if in_hits and "price" in node and any(k in node for k in _TITLE_KEYS) and any(k in node for k in _LINK_KEYS):
+                yield node
+                continue
+            queue.extend(
+                (value, in_hits or key in _HIT_KEYS)
+                for key, value in node.items() if key not in _PROMO_KEYS
+            )
+        elif isinstance(node, list):
+            queue.extend((item, in_hits) for item in node)
+
+def parse_next_data(page_content, search_query):
+    """
+    Extract listings from the __NEXT_DATA__ JSON blob.
+    Returns None when the blob is missing or holds no listings, so the
+    caller can fall back to parse_listing_cards.
+    """
+    match = _NEXT_DATA_RE.search(page_content)
+    if not match:
+        return None
+    try:
+        data = orjson.loads(match.group(1))
+    except orjson.JSONDecodeError:
+        return None
+
+    rows = {}
+    for obj in _iter_listing_objects(data):
+        title, price, link = _field(obj, _TITLE_KEYS), _field(obj, ("price",)), _field(obj, _LINK_KEYS)
+        if not isinstance(title, str) or not isinstance(link, str):
+            continue
+        if isinstance(price, str):
+            digits = _NON_DIGIT.sub('', price)
+            if not digits:
+                continue
+            price = int(digits)
+        if not isinstance(price, (int, float)) or not 0 <= price <= _MAX_PRICE:
+            continue
+        link = link if link.startswith('http') else "https://uae.dubizzle.com" + link
+        location = _field(obj, _LOCATION_KEYS)
+        rows.setdefault(link, (title.strip(), int(price), location if isinstance(location, str) else "UAE"))
+
+    if not rows:
+        return None
+    titles, prices, locations = zip(*rows.values())
+    return listings_frame(search_query, list(titles), np.array(prices, dtype=np.int32), list(locations), list(rows))
+
+# Counts rendered cards without building a DOM; see LISTING_CARD_SELECTOR.
+_CARD_MARKER_RE = re.compile(r'<div\b[^>]*\bdata-testid="listing-card"')
+
+def parse_page(page_content, search_query):
+    """
+    Parse a results page, preferring the __NEXT_DATA__ payload.
+    The payload is only trusted when it matches the rendered card count
+    exactly: fewer rows means it missed hits, more means it picked up ads
+    from outside the results. The DOM is parsed only on that fallback.
+    Returns (df, number of DOM cards), with None cards for the payload path.
+    """
+    n_cards = len(_CARD_MARKER_RE.findall(page_content))
+    if n_cards == 0:
+        return listings_frame(search_query, [], np.empty(0, np.int32), [], []), 0
+    df = parse_next_data(page_content, search_query)
+    if df is not None and len(df) == n_cards:
+        return df, None
+    listings = LexborHTMLParser(page_content).css(LISTING_CARD_SELECTOR)
+    return parse_listing_cards(listings, search_query), len(listings)
+
+# --- ARBITRAGE LOGIC ---
+def _median(values):
+    """Median by quickselect (np.partition), O(n) instead of a full sort."""
+    k = values.size // 2
+    if values.size % 2:
+        return np.partition(values, k)[k]
+    part = np.partition(values, (k - 1, k))
+    return 0.5 * (part[k - 1] + part[k])
+
+def calculate_arbitrage(df, reference=None):
+    """
+    Score each listing against its model's median price. With a reference
+    frame (Model, Price), e.g. recent scan history, the stats come from it
+    instead of the current scan alone.
+    """
+    # No early return: an empty result still carries the derived columns.
+    mask = df['Price'].to_numpy() > 100
+    base = df[mask]
+    p = base['Price'].to_numpy(dtype=np.float64)
+    codes, models = pd.factorize(base['Model'])
+
+    ref_groups = {}
+    if reference is not None and not reference.empty:
+        ref = reference[reference['Price'].to_numpy() > 100]
+        ref_groups = {model: grp.to_numpy(dtype=np.float64) for model, grp in ref.groupby('Model', observed=True)['Price']}
+
+    # Per-model stats on plain arrays; a lone or flat-priced model gets std 1.
+    medians = np.empty(len(models))
+    stds = np.ones(len(models))
+    for g, model in enumerate(models):
+        group = ref_groups.get(model)
+        if group is None or group.size == 0:
+            group = p[codes == g]
+        medians[g] = _median(group)
+        if group.size > 1:
+            sd = group.std(ddof=1)
+            if sd > 0:
+                stds[g] = sd
+
+    m = medians[codes]
+    profit = m - p
+    return pd.DataFrame({
+        **{col: base[col] for col in base.columns},
+        'Market_Median': m.astype(np.float32),
+        'Profit_AED': profit.astype(np.float32),
+        'ROI_%': (profit / p * 100.0).astype(np.float32),
+        'Z_Score': (-profit / stds[codes]).astype(np.float32),
+    }, copy=False)
+
+# --- SCAN HISTORY ---
+SCAN_TTL_SECONDS = 300
+HISTORY_DB = pathlib.Path.home() / ".cache/dubizzle_history.sqlite3"
+
+@st.cache_resource
+def get_history_db():
+    """
+    One SQLite connection per process, shared across sessions under a lock.
+    Rows are keyed by (Model, Link), so each holds an ad's latest sighting.
+    """
+    HISTORY_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS listings (
+            Model TEXT NOT NULL,
+            Link TEXT NOT NULL,
+            Timestamp INTEGER NOT NULL,
+            Title TEXT,
+            Price INTEGER NOT NULL,
+            Location TEXT,
+            PRIMARY KEY (Model, Link)
         )
-        
-        user_agents = [
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
-        ]
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS listings_model_ts ON listings (Model, Timestamp)")
+    conn.commit()
+    return conn, threading.Lock()
+
+def _query_history(sql, params):
+    conn, lock = get_history_db()
+    with lock:
+        df = pd.read_sql_query(sql, conn, params=params)
+    if 'Timestamp' in df:
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='ns')
+    return df.astype({col: dtype for col, dtype in LISTING_DTYPES.items() if col in df})
+
+def _ttl_cutoff(seconds):
+    return (pd.Timestamp.now() - pd.Timedelta(seconds=seconds)).value
+
+def load_recent_scan(category):
+    """Return the latest stored scan for category if it is younger than the TTL."""
+    df = _query_history(
+        "SELECT Timestamp, Title, Model, Price, Location, Link FROM listings "
+        "WHERE Model = ? AND Timestamp >= ? "
+        "AND Timestamp = (SELECT MAX(Timestamp) FROM listings WHERE Model = ?)",
+        (category, _ttl_cutoff(SCAN_TTL_SECONDS), category)
+    )
+    return df if not df.empty else None
+
+def load_price_history(models, minutes):
+    """Prices of every ad seen for models within the last `minutes`."""
+    placeholders = ",".join("?" * len(models))
+    return _query_history(
+        f"SELECT Model, Price FROM listings WHERE Model IN ({placeholders}) AND Timestamp >= ?",
+        (*models, _ttl_cutoff(minutes * 60))
+    )
 
-        context = await browser.new_context(
-            user_agent=random.choice(user_agents),
-            viewport={'width': 1280, 'height': 800},
-            java_script_enabled=True
+def append_history(df):
+    df = df[df['Link'] != "#"]
+    if df.empty:
+        return
+    rows = zip(
+        df['Model'].astype(str).tolist(),
+        df['Link'].tolist(),
+        # Stored as epoch ns to match _ttl_cutoff; the frame may hold [us].
+        df['Timestamp'].dt.as_unit('ns').astype('int64').tolist(),
+        df['Title'].tolist(),
+        df['Price'].tolist(),
+        df['Location'].astype(str).tolist(),
+    )
+    conn, lock = get_history_db()
+    with lock, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO listings (Model, Link, Timestamp, Title, Price, Location) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
         )
 
-        page = await context.new_page()
-        await page.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        
-        try:
-            add_log("Connecting via proxy and setting cookies...")
-            response = await page.goto(base_url, wait_until="domcontentloaded", timeout=30000)
-            add_log(f"Initial Connection Status: {response.status}")
-            
-            if response.status == 407:
-                add_log("CRITICAL: Proxy Authentication Required (407).")
-                st.error("Authentication failed. Please verify your proxy username and password.")
-                return pd.DataFrame(), None, "407 Error", 407, proxy_config
+# --- RESULT CACHE ---
+def proxy_pool_key(proxy_list):
+    """Order-independent digest of the proxy pool, so equal pools share cache entries."""
+    if not proxy_list:
+        return ""
+    return hashlib.blake2b("\n".join(sorted(proxy_list)).encode(), digest_size=16).hexdigest()
+
+class _ScrapeFailed(Exception):
+    """
+    Raised out of the cached scrapers so a failed scan is never cached;
+    result holds what the function would otherwise have returned.
+    """
+    def __init__(self, result):
+        super().__init__("scrape failed")
+        self.result = result
 
-            await asyncio.sleep(random.uniform(1, 3))
+@st.cache_data(ttl=SCAN_TTL_SECONDS, show_spinner=False)
+def cached_scrape(search_query, proxy_key="", capture_screenshot=False, _proxy_list=None, _force=False):
+    """
+    Sync wrapper around scrape_dubizzle, keyed on the query and proxy pool.
+    Repeat scans within the TTL skip the browser launch entirely, and so
+    do scans the on-disk history already holds a fresh copy of, unless a
+    screenshot is wanted. Empty or non-200 scans raise _ScrapeFailed so the
+    next click retries them.
+    Returns (df, screenshot, debug); debug is [html_sample, status_code,
+    proxy_config], or None when served from history.
+    """
+    if not _force and not capture_screenshot:
+        recent = load_recent_scan(search_query)
+        if recent is not None:
+            add_log(f"Served {search_query} from scan history.")
+            return recent, None, None
+    df, screenshot, *debug = run_async(scrape_dubizzle(get_browser_pool(), search_query, capture_screenshot, _proxy_list, warm=True))
+    result = (df, screenshot, debug)
+    if df.empty or debug[1] != 200:
+        raise _ScrapeFailed(result)
+    append_history(df)
+    return result
 
-            add_log(f"Fetching search results...")
-            response = await page.goto(search_url, wait_until="networkidle", timeout=45000)
-            status_code = response.status
-            add_log(f"Search Results Status: {status_code}")
+@st.cache_data(ttl=SCAN_TTL_SECONDS, show_spinner=False)
+def cached_scrape_many(queries, proxy_key="", _proxy_list=None):
+    frames = [load_recent_scan(q) for q in queries]
+    stale = [q for q, f in zip(queries, frames) if f is None]
+    if stale:
+        # scrape_many only keeps rows from successful scans, so this persists
+        # just the categories that came back with results.
+        scraped = run_async(scrape_many(get_browser_pool(), stale, _proxy_list))
+        append_history(scraped)
+        frames.append(scraped)
+    df = pd.concat([f for f in frames if f is not None], ignore_index=True).astype(LISTING_DTYPES)
+    # Categories that came back empty would otherwise stay empty for the TTL.
+    missing = set(stale) - set(df['Model'].astype(str))
+    if missing:
+        add_log(f"No results for: {', '.join(sorted(missing))}")
+        raise _ScrapeFailed(df)
+    return df
 
-            if debug_mode:
-                try:
-                    add_log("Capturing visual state...")
-                    screenshot_data = await page.screenshot(type="jpeg", quality=50, timeout=10000, animations="disabled")
-                    add_log("Screenshot saved.")
-                except Exception as e:
-                    add_log(f"Screenshot skipped: {str(e)}")
-
-            page_content = await page.content()
-            if "Incapsula" in page_content or "incident_id" in page_content:
-                add_log("Firewall Block detected in HTML content.")
-            
-            html_sample = page_content[:1000]
-            
-            soup = BeautifulSoup(page_content, 'html.parser')
-            listings = soup.find_all('div', {'data-testid': 'listing-card'})
-            
-            add_log(f"Parsed {len(listings)} items from the page.")
-            
-            for item in listings:
-                try:
-                    title_elem = item.find('h2', {'data-testid': 'listing-title'})
-                    price_elem = item.find('div', {'data-testid': 'listing-price'})
-                    link_elem = item.find('a')
-                    
-                    if title_elem and price_elem:
-                        price_val = int(''.join(filter(str.isdigit, price_elem.text.strip())))
-                        raw_link = link_elem['href'] if link_elem else "#"
-                        
-                        results.append({
-                            "Timestamp": pd.Timestamp.now(),
-                            "Title": title_elem.text.strip(),
-                            "Model": search_query,
-                            "Price": price_val,
-                            "Location": item.find('span', {'data-testid': 'listing-location'}).text.strip() if item.find('span', {'data-testid': 'listing-location'}) else "UAE",
-                            "Link": raw_link if raw_link.startswith('http') else "https://uae.dubizzle.com" + raw_link
-                        })
-                except: continue
-                    
-        except Exception as e:
-            add_log(f"ERROR: {str(e)}")
-        finally:
-            await browser.close()
-            add_log("Browser closed.")
-            
-    return pd.DataFrame(results), screenshot_data, html_sample, status_code, proxy_config
+def frame_to_parquet(df):
+    return df.to_parquet(engine='pyarrow', compression='zstd', index=False)
 
-# --- ARBITRAGE LOGIC ---
-def calculate_arbitrage(df):
-    if df.empty: return df
-    filtered_df = df[df['Price'] > 100].copy()
-    if filtered_df.empty: return df
-    median = filtered_df['Price'].median()
-    filtered_df['Market_Median'] = median
-    filtered_df['Profit_AED'] = filtered_df['Market_Median'] - filtered_df['Price']
-    filtered_df['ROI_%'] = (filtered_df['Profit_AED'] / filtered_df['Price']) * 100
-    return filtered_df
+def frame_from_parquet(data):
+    return pd.read_parquet(io.BytesIO(data), engine='pyarrow')
+
+@st.cache_data(show_spinner=False)
+def cached_arbitrage(scan_parquet, reference=None):
+    # Keyed on the stored bytes, so a rerun hashes a blob instead of a frame.
+    return calculate_arbitrage(frame_from_parquet(scan_parquet), reference)
+
+@st.cache_data(show_spinner=False)
+def make_price_histogram(df):
+    # A plain dict pickles and unpickles without Plotly re-validating a Figure.
+    return px.histogram(df, x="Price", color="Model", title="Price Distribution").to_dict()
 
 # --- UI MAIN ---
+CATEGORIES = ["iPhone 15 Pro", "Rolex Submariner", "PS5 Console", "MacBook M3"]
+
+def render_debug(screenshot, html_snippet, status, p_used):
+    with st.expander("🛠️ Debug Information"):
+        c1, c2 = st.columns(2)
+        with c1:
+            st.write(f"**HTTP Status:** {status}")
+            if p_used: st.write(f"**Used Proxy:** {p_used['server']}")
+            if screenshot: st.image(screenshot, caption="Last Scanned View")
+        with c2:
+            st.code(html_snippet, language="html")
+
+DEALS_PAGE_SIZE = 50
+
+def render_results(df, roi_threshold, key="main"):
+    # Only the top slice is shown, so partial selection beats a full sort.
+    hot_mask = df['ROI_%'].to_numpy() >= roi_threshold
+    hot_count = int(hot_mask.sum())
+    shown = st.session_state.deals_shown.get(key, DEALS_PAGE_SIZE)
+    deals = df[hot_mask].nlargest(shown, 'ROI_%')
+    
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Scanned", len(df))
+    m2.metric("Hot Deals", hot_count)
+    # The median ROI is scored against, which may come from history.
+    m3.metric("Market Median", f"AED {df['Market_Median'].median():,.0f}")
+    
+    st.plotly_chart(make_price_histogram(df[['Model', 'Price']]), use_container_width=True)
+    
+    st.subheader("🔥 Top Deals")
+    if not st.toggle("Expand card view", key=f"{key}_card_view"):
+        # Scale bars to the best deal shown; a fixed cap flattens outliers.
+        roi_scale = max(float(deals['ROI_%'].max()), 1.0) if not deals.empty else 1.0
+        st.dataframe(
+            deals[['Title', 'Model', 'Location', 'Price', 'Market_Median', 'ROI_%', 'Link']],
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'Link': st.column_config.LinkColumn('Ad', display_text='View'),
+                'ROI_%': st.column_config.ProgressColumn('ROI', format='%.1f%%', min_value=0, max_value=roi_scale),
+                'Price': st.column_config.NumberColumn(format='AED %d'),
+                'Market_Median': st.column_config.NumberColumn('Median', format='AED %d'),
+            }
+        )
+    else:
+        rows = deals[['Title', 'Location', 'Price', 'ROI_%', 'Link']].itertuples(index=False, name=None)
+        for title, location, price, roi, link in rows:
+            with st.container():
+                cols = st.columns([3, 1, 1])
+                cols[0].markdown(f"**{title}**\n\n📍 {location}")
+                cols[1].markdown(f"💰 **AED {price:,}**\n\n**ROI: {roi:.1f}%**")
+                cols[2].link_button("View Ad", link, use_container_width=True)
+                st.divider()
+
+    if hot_count > shown:
+        st.caption(f"Showing top {shown} of {hot_count} deals.")
+        if st.button("Show more", key=f"{key}_show_more"):
+            st.session_state.deals_shown[key] = shown + DEALS_PAGE_SIZE
+            st.rerun()
+
 def main():
     st.sidebar.title("🔧 Arbitrage Settings")
-    category = st.sidebar.selectbox("Category", ["iPhone 15 Pro", "Rolex Submariner", "PS5 Console", "MacBook M3"])
+    category = st.sidebar.selectbox("Category", CATEGORIES)
+    scan_categories = st.sidebar.multiselect("Multi-scan categories", CATEGORIES, default=CATEGORIES)
     roi_threshold = st.sidebar.slider("Min ROI % Filter", 0, 50, 10)
+    median_window = st.sidebar.slider(
+        "Median window (minutes)", 0, 180, 0, step=15,
+        help="Price ads against every listing stored in this window. 0 uses the current scan only."
+    )
     
     st.sidebar.subheader("🌐 Proxy Settings")
     use_proxies = st.sidebar.toggle("Enable Proxies", value=True)
@@ -235,59 +898,87 @@ def main():
     )
     
     proxy_list = [p.strip() for p in proxies_raw.split("\n") if p.strip()] if use_proxies else None
+    proxy_key = proxy_pool_key(proxy_list)
     debug_mode = st.sidebar.checkbox("Enable Debug Mode", value=True)
+    capture_screenshot = debug_mode and st.sidebar.checkbox("Capture screenshot", key="want_screenshot")
     
     if debug_mode:
         st.sidebar.subheader("Terminal Output")
         log_text = "\n".join(st.session_state.debug_logs)
         st.sidebar.markdown(f'<div class="debug-log">{log_text}</div>', unsafe_allow_html=True)
         if st.sidebar.button("Clear History"):
-            st.session_state.debug_logs = []
+            st.session_state.debug_logs = deque(maxlen=MAX_LOG_LINES)
             st.rerun()
 
     st.title("🚀 Dubizzle Arbitrage Dashboard")
     
-    if st.button("🔍 Scan Live Market", use_container_width=True):
-        if not st.session_state.get('browser_installed'):
+    b1, b2, b3 = st.columns([3, 2, 1])
+    scan_clicked = b1.button("🔍 Scan Live Market", use_container_width=True)
+    scan_all_clicked = b2.button("🌍 Scan selected categories", use_container_width=True, disabled=not scan_categories)
+    force_refresh = b3.button("♻️ Force refresh", use_container_width=True)
+    if force_refresh:
+        cached_scrape.clear()
+        cached_scrape_many.clear()
+        scan_clicked = True
+
+    # The screenshot is shown in the scanning run only and never kept.
+    screenshot = None
+    if scan_clicked or scan_all_clicked:
+        if not ensure_browser_installed():
             st.error("Wait for browser setup to complete.")
             return
 
-        with st.spinner("Scanning..."):
-            df_raw, screenshot, html_snippet, status, p_used = asyncio.run(scrape_dubizzle(category, debug_mode, proxy_list))
-            
-            if debug_mode:
-                with st.expander("🛠️ Debug Information"):
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        st.write(f"**HTTP Status:** {status}")
-                        if p_used: st.write(f"**Used Proxy:** {p_used['server']}")
-                        if screenshot: st.image(screenshot, caption="Last Scanned View")
-                    with c2:
-                        st.code(html_snippet, language="html")
-
-            if not df_raw.empty:
-                df = calculate_arbitrage(df_raw)
-                deals = df[df['ROI_%'] >= roi_threshold].sort_values(by='ROI_%', ascending=False)
-                
-                m1, m2, m3 = st.columns(3)
-                m1.metric("Scanned", len(df))
-                m2.metric("Hot Deals", len(deals))
-                m3.metric("Median Price", f"AED {df['Market_Median'].iloc[0]:,.0f}")
-                
-                st.plotly_chart(px.histogram(df, x="Price", title="Price Distribution"), use_container_width=True)
-                
-                st.subheader("🔥 Top Deals")
-                for _, row in deals.iterrows():
-                    with st.container():
-                        cols = st.columns([3, 1, 1])
-                        cols[0].markdown(f"**{row['Title']}**\n\n📍 {row['Location']}")
-                        cols[1].markdown(f"💰 **AED {row['Price']:,}**\n\n**ROI: {row['ROI_%']:.1f}%**")
-                        cols[2].link_button("View Ad", row['Link'], use_container_width=True)
-                        st.divider()
-            else:
-                st.error("No items found.")
-                if status == 407:
-                    st.warning("Authentication failed. Check your proxy list format.")
+        # Kept in session state so widget changes re-render without rescanning.
+        st.session_state.deals_shown = {}
+        if scan_all_clicked:
+            with st.spinner(f"Scanning {len(scan_categories)} categories..."):
+                try:
+                    df_raw = cached_scrape_many(tuple(scan_categories), proxy_key, proxy_list)
+                except _ScrapeFailed as e:
+                    df_raw = e.result
+            debug_info, categories = None, scan_categories
+        else:
+            with st.spinner("Scanning..."):
+                try:
+                    result = cached_scrape(category, proxy_key, capture_screenshot, proxy_list, force_refresh)
+                except _ScrapeFailed as e:
+                    result = e.result
+            df_raw, screenshot, debug_info = result
+            categories = None
+        # Stored as Parquet bytes and decoded only when the arbitrage cache misses.
+        st.session_state.scan = {
+            "parquet": frame_to_parquet(df_raw),
+            "models": df_raw['Model'].unique().tolist(),
+            "debug": debug_info,
+            "categories": categories,
+        }
+
+    scan = st.session_state.get('scan')
+    if scan is None:
+        return
+
+    if debug_mode and scan["debug"]:
+        render_debug(screenshot, *scan["debug"])
+
+    reference = None
+    if median_window and scan["models"]:
+        reference = load_price_history(scan["models"], median_window)
+
+    df = cached_arbitrage(scan["parquet"], reference) if scan["models"] else None
+    if scan["categories"] and df is not None and not df.empty:
+        for cat, tab in zip(scan["categories"], st.tabs(scan["categories"])):
+            with tab:
+                cat_df = df[df['Model'] == cat]
+                if cat_df.empty:
+                    st.error(f"No items found for {cat}.")
+                else:
+                    render_results(cat_df, roi_threshold, key=cat)
+    elif df is not None and not df.empty:
+        render_results(df, roi_threshold)
+    else:
+        st.error("No items found.")
+        if scan["debug"] and scan["debug"][1] == 407:
+            st.warning("Authentication failed. Check your proxy list format.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file